@@ -44,16 +44,28 @@ class TextMelDataset(torch.utils.data.Dataset):
         return len(self.df)
 
 
+def round_up_to_bucket(length, bucket_size):
+  return -(-length // bucket_size) * bucket_size
+
+
 def text_mel_collate_fn(batch):
   text_length_max = torch.tensor(
     [text.shape[-1] for text, _ in batch], 
     dtype=torch.int32
-  ).max()
+  ).max().item()
 
   mel_length_max = torch.tensor(
     [mel.shape[-1] for _, mel in batch],
     dtype=torch.int32
-  ).max()
+  ).max().item()
+
+  # Stop token target is set on the last real frame, not on bucket padding
+  stop_index = mel_length_max - 1
+
+  if hp.torch_compile:
+    # Static shapes for the compiled forward
+    text_length_max = round_up_to_bucket(text_length_max, hp.text_bucket_size)
+    mel_length_max = round_up_to_bucket(mel_length_max, hp.mel_bucket_size)
 
   
   text_lengths = []
@@ -92,7 +104,7 @@ def text_mel_collate_fn(batch):
       mel_length_max
   )
   stop_token_padded = (~stop_token_padded).float()
-  stop_token_padded[:, -1] = 1.0
+  stop_token_padded[:, stop_index] = 1.0
   
   return texts_padded, \
          text_lengths, \
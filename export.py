@@ -0,0 +1,79 @@
+import torch
+import torch.nn.functional as F
+
+from hyperparams import hp
+from model import TransformerTTS, DecoderStep
+from text_to_seq import text_to_seq
+
+
+def export_decoder_step(model, text, onnx_path, max_length=800):
+  """
+  Traces the decoder step of `model` for `text` (1, L) and exports it
+  to `onnx_path` with static shapes (no dynamic axes), e.g. for a TensorRT engine.
+  The shapes are fixed: text length S = hp.max_text_length and k, v cache
+  length `max_length`. So for any text with L <= S, pad it with zeros to S
+  before `model.encode` (as done here) and pass its real length, then
+  `src_key_padding_mask` masks the padding; decode at most `max_length` frames.
+  Returns the traced TorchScript module.
+  """
+  assert text.shape[1] <= hp.max_text_length
+
+  model.eval()
+  decoder_step = DecoderStep(model).eval()
+
+  with torch.no_grad():
+    text_lengths = torch.tensor(text.shape[1]).unsqueeze(0).to(text.device)
+    text = F.pad(text, [0, hp.max_text_length - text.shape[1]])
+    memory, src_key_padding_mask = model.encode(text, text_lengths)
+    caches = model.init_caches(memory, max_length)
+
+    inputs = (
+      torch.zeros((1, 1, hp.mel_freq), device=text.device), # SOS
+      torch.zeros(1, dtype=torch.long, device=text.device),
+      memory,
+      src_key_padding_mask,
+      torch.stack([cache["self_k"] for cache in caches]),
+      torch.stack([cache["self_v"] for cache in caches]),
+      torch.stack([cache["memory_k"] for cache in caches]),
+      torch.stack([cache["memory_v"] for cache in caches])
+    )
+
+    traced_decoder_step = torch.jit.trace(decoder_step, inputs)
+
+    torch.onnx.export(
+      decoder_step,
+      inputs,
+      onnx_path,
+      input_names=[
+        "mel_frame", 
+        "step", 
+        "memory", 
+        "src_key_padding_mask", 
+        "self_k", 
+        "self_v", 
+        "memory_k", 
+        "memory_v"
+      ],
+      output_names=[
+        "mel_linear", 
+        "stop_token", 
+        "self_k_out", 
+        "self_v_out"
+      ]
+    )
+
+  return traced_decoder_step
+
+
+if __name__ == "__main__":
+  hp.torch_compile = False
+  
+  train_saved_path = f"{hp.save_path}/train_{hp.save_name}"
+  state = torch.load(train_saved_path)
+  model = TransformerTTS().cuda()
+  model.load_state_dict(state["model"])
+  model.fuse_for_inference()
+
+  text = text_to_seq("Hello, World.").unsqueeze(0).cuda()
+  traced_decoder_step = export_decoder_step(model, text, f"{hp.save_path}/decoder_step.onnx")
+  traced_decoder_step.save(f"{hp.save_path}/decoder_step.pt")
@@ -53,12 +53,28 @@ class Hyperparams:
   encoder_kernel_size = 3
   postnet_kernel_size = 5
 
+  # Fixed text length S of the exported decoder step (export.py),
+  # texts are zero padded to it
+  max_text_length = 256
+
   # Other
   batch_size = 32
   grad_clip = 1.0
   lr = 2.0 * 1e-4
   r_gate = 1.0
 
+  # torch.compile for pre-net, post-net, encoder and decoder blocks
+  # and the whole forward (CUDA graphs in training), opt-in:
+  # also buckets batch lengths, which adds zero frames to the loss means
+  torch_compile = False
+  # With torch_compile padded text/mel lengths in a batch are multiples of these,
+  # so the compiled forward sees only a few static shapes
+  text_bucket_size = 64
+  mel_bucket_size = 128
+  # Recompute encoder/decoder block activations in backward:
+  # less memory for a bigger batch_size, more compute per step
+  activation_checkpointing = False
+
   step_print = 20
   step_test = 20
   step_save = 20
@@ -9,7 +9,12 @@ def mask_from_seq_lengths(
     our input was `[2, 2, 3]`, with a `max_length` of 4, we'd return
     `[[1, 1, 0, 0], [1, 1, 0, 0], [1, 1, 1, 0]]`.
     """
-    # (batch_size, max_length)
-    ones = sequence_lengths.new_ones(sequence_lengths.size(0), max_length)
-    range_tensor = ones.cumsum(dim=1)
+    # (max_length,) positions are broadcasted to (batch_size, max_length),
+    # no (batch_size, max_length) ones + cumsum
+    range_tensor = torch.arange(
+        1, 
+        max_length + 1, 
+        device=sequence_lengths.device, 
+        dtype=sequence_lengths.dtype
+    )
     return sequence_lengths.unsqueeze(1) >= range_tensor 
\ No newline at end of file
@@ -1,7 +1,10 @@
 import math
+import re
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 
 import pandas as pd
 from tqdm import tqdm
@@ -14,17 +17,133 @@ from text_to_seq import text_to_seq
 # https://github.com/NVIDIA/tacotron2/blob/master/model.py
 # https://github.com/NVIDIA/tacotron2/blob/master/layers.py
 
+@torch.no_grad()
+def fuse_conv_bn_pairs(module, count):
+  # Folds bn_i into conv_i weights for i in 1..count,
+  # one-way: the module is for inference only after it
+  for i in range(1, count + 1):
+    conv = getattr(module, f"conv_{i}").eval()
+    bn = getattr(module, f"bn_{i}").eval()
+    setattr(module, f"conv_{i}", fuse_conv_bn_eval(conv, bn))
+    setattr(module, f"bn_{i}", nn.Identity())
+
+
+class MultiheadAttention(nn.Module):
+  """
+  Drop-in for torch.nn.MultiheadAttention (batch_first=True) on top of
+  F.scaled_dot_product_attention. Parameter names are the same as in
+  torch.nn.MultiheadAttention, so old checkpoints still load.
+
+  attn_mask must be already combined with key padding and broadcastable
+  to (N, HEADS, L, S): bool (True - take part in attention) or float (added).
+  """
+  def __init__(self, embed_dim, num_heads, dropout=0.0):
+    super(MultiheadAttention, self).__init__()
+    self.embed_dim = embed_dim
+    self.num_heads = num_heads
+    self.head_dim = embed_dim // num_heads
+    self.dropout = dropout
+
+    self.in_proj_weight = nn.Parameter(
+      torch.empty((3 * embed_dim, embed_dim))
+    )
+    self.in_proj_bias = nn.Parameter(
+      torch.empty(3 * embed_dim)
+    )
+    self.out_proj = nn.Linear(
+      embed_dim, 
+      embed_dim
+    )
+
+    nn.init.xavier_uniform_(self.in_proj_weight)
+    nn.init.constant_(self.in_proj_bias, 0.0)
+    nn.init.constant_(self.out_proj.bias, 0.0)
+
+  def split_heads(self, x):
+    N, T, _ = x.shape
+    return x.view(N, T, self.num_heads, self.head_dim).transpose(1, 2) # (N, HEADS, T, HEAD_DIM)
+
+  def q_projection(self, query):
+    E = self.embed_dim
+    return self.split_heads(
+      F.linear(query, self.in_proj_weight[:E], self.in_proj_bias[:E])
+    )
+
+  def kv_projection(self, key, value):
+    E = self.embed_dim
+
+    if key is value:
+      # k, v in one GEMM
+      N, S, _ = key.shape
+      kv = F.linear(
+        key, 
+        self.in_proj_weight[E:], 
+        self.in_proj_bias[E:]
+      ).view(N, S, 2, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+      return kv[0], kv[1]
+
+    k = self.split_heads(
+      F.linear(key, self.in_proj_weight[E:2*E], self.in_proj_bias[E:2*E])
+    )
+    v = self.split_heads(
+      F.linear(value, self.in_proj_weight[2*E:], self.in_proj_bias[2*E:])
+    )
+    return k, v
+
+  def in_projection(self, query, key, value):
+    if query is key and key is value:
+      # self-attention: q, k, v in one GEMM
+      N, T, _ = query.shape
+      qkv = F.linear(
+        query, 
+        self.in_proj_weight, 
+        self.in_proj_bias
+      ).view(N, T, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+      return qkv[0], qkv[1], qkv[2]
+
+    q = self.q_projection(query)
+    k, v = self.kv_projection(key, value)
+    return q, k, v
+
+  def attend(self, q, k, v, attn_mask = None):
+    # q - (N, HEADS, L, HEAD_DIM), k, v - (N, HEADS, S, HEAD_DIM)
+    N, _, L, _ = q.shape
+
+    x = F.scaled_dot_product_attention(
+      q, 
+      k, 
+      v, 
+      attn_mask=attn_mask,
+      dropout_p=self.dropout if self.training else 0.0,
+      is_causal=False
+    ) # (N, HEADS, L, HEAD_DIM)
+
+    x = x.transpose(1, 2).reshape(N, L, self.embed_dim)
+    x = self.out_proj(x)
+
+    return x
+
+  def forward(
+    self, 
+    query, 
+    key, 
+    value, 
+    attn_mask = None
+  ):
+    q, k, v = self.in_projection(query, key, value)
+    return self.attend(q, k, v, attn_mask=attn_mask)
+
+
 class EncoderBlock(nn.Module):
   def __init__(self):
     super(EncoderBlock, self).__init__()
     self.norm_1 = nn.LayerNorm(
       normalized_shape=hp.embedding_size
     )
-    self.attn = torch.nn.MultiheadAttention(
+    self.attn = MultiheadAttention(
       embed_dim=hp.embedding_size,
       num_heads=4,
-      dropout=0.1,
-      batch_first=True
+      dropout=0.1
     )
     self.dropout_1 = torch.nn.Dropout(0.1)
 
@@ -48,16 +167,14 @@ class EncoderBlock(nn.Module):
   def forward(
     self, 
     x,
-    attn_mask = None, 
-    key_padding_mask = None
+    attn_mask = None
   ):
     x_out = self.norm_1(x)
-    x_out, _ = self.attn(
+    x_out = self.attn(
       query=x_out, 
       key=x_out, 
       value=x_out,
-      attn_mask=attn_mask,
-      key_padding_mask=key_padding_mask
+      attn_mask=attn_mask
     )
     x_out = self.dropout_1(x_out)
     x = x + x_out    
@@ -81,22 +198,20 @@ class DecoderBlock(nn.Module):
     self.norm_1 = nn.LayerNorm(
       normalized_shape=hp.embedding_size
     )
-    self.self_attn = torch.nn.MultiheadAttention(
+    self.self_attn = MultiheadAttention(
       embed_dim=hp.embedding_size,
       num_heads=4,
-      dropout=0.1,
-      batch_first=True
+      dropout=0.1
     )
     self.dropout_1 = torch.nn.Dropout(0.1)
 
     self.norm_2 = nn.LayerNorm(
       normalized_shape=hp.embedding_size
     )
-    self.attn = torch.nn.MultiheadAttention(
+    self.attn = MultiheadAttention(
       embed_dim=hp.embedding_size,
       num_heads=4,
-      dropout=0.1,
-      batch_first=True
+      dropout=0.1
     )    
     self.dropout_2 = torch.nn.Dropout(0.1)
 
@@ -121,26 +236,42 @@ class DecoderBlock(nn.Module):
     x,
     memory,
     x_attn_mask = None, 
-    x_key_padding_mask = None,
     memory_attn_mask = None,
-    memory_key_padding_mask = None
+    cache = None,
+    cache_index = None,
+    cache_length = None
   ):
-    x_out, _ = self.self_attn(
-      query=x, 
-      key=x, 
-      value=x,
-      attn_mask=x_attn_mask,
-      key_padding_mask=x_key_padding_mask
+    # cache - preallocated k, v for step by step decoding (see TransformerTTS.init_caches),
+    # x is only the frames at cache_index (1,) then;
+    # cache_length - attend only to the first cache_length (filled) frames,
+    # None - to the whole buffer, x_attn_mask hides the unfilled part
+    q, k, v = self.self_attn.in_projection(x, x, x)
+    if cache is not None:
+      cache["self_k"].index_copy_(2, cache_index, k)
+      cache["self_v"].index_copy_(2, cache_index, v)
+      k = cache["self_k"][:, :, :cache_length]
+      v = cache["self_v"][:, :, :cache_length]
+
+    x_out = self.self_attn.attend(
+      q, 
+      k, 
+      v,
+      attn_mask=x_attn_mask
     )
     x_out = self.dropout_1(x_out)
     x = self.norm_1(x + x_out)
+
+    if cache is not None:
+      memory_k = cache["memory_k"]
+      memory_v = cache["memory_v"]
+    else:
+      memory_k, memory_v = self.attn.kv_projection(memory, memory)
      
-    x_out, _ = self.attn(
-      query=x,
-      key=memory,
-      value=memory,
-      attn_mask=memory_attn_mask,
-      key_padding_mask=memory_key_padding_mask
+    x_out = self.attn.attend(
+      self.attn.q_projection(x),
+      memory_k,
+      memory_v,
+      attn_mask=memory_attn_mask
     )
     x_out = self.dropout_2(x_out)
     x = self.norm_2(x + x_out)
@@ -240,6 +371,10 @@ class EncoderPreNet(nn.Module):
     return x
 
 
+  def fuse_for_inference(self):
+    fuse_conv_bn_pairs(self, 3)
+
+
 class PostNet(nn.Module):
   def __init__(self):
     super(PostNet, self).__init__()  
@@ -362,6 +497,10 @@ class PostNet(nn.Module):
     return x
 
 
+  def fuse_for_inference(self):
+    fuse_conv_bn_pairs(self, 6)
+
+
 class DecoderPreNet(nn.Module):
   def __init__(self):
     super(DecoderPreNet, self).__init__()
@@ -379,19 +518,32 @@ class DecoderPreNet(nn.Module):
     x = self.linear_1(x)
     x = F.relu(x)
     
-    x = F.dropout(x, p=0.5, training=True)
+    x = F.dropout(x, p=0.5, training=self.training)
 
     x = self.linear_2(x)
     x = F.relu(x)    
-    x = F.dropout(x, p=0.5, training=True)
+    x = F.dropout(x, p=0.5, training=self.training)
 
     return x    
 
 
+def rename_block_keys(module, state_dict, prefix, *args):
+  # encoder_block_1.* -> encoder_blocks.0.*, decoder_block_1.* -> decoder_blocks.0.*
+  for key in list(state_dict.keys()):
+    match = re.match(rf"{re.escape(prefix)}(encoder|decoder)_block_(\d+)\.(.*)", key)
+    if match is not None:
+      name, i, rest = match.groups()
+      state_dict[f"{prefix}{name}_blocks.{int(i) - 1}.{rest}"] = state_dict.pop(key)
+
+
 class TransformerTTS(nn.Module):
   def __init__(self, device="cuda"):
     super(TransformerTTS, self).__init__()
 
+    # TF32 for matmuls and convs on Ampere+, no effect on older GPUs
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     self.encoder_prenet = EncoderPreNet()
     self.decoder_prenet = DecoderPreNet()
     self.postnet = PostNet()
@@ -401,21 +553,97 @@ class TransformerTTS(nn.Module):
         embedding_dim=hp.embedding_size
     )
 
-    self.encoder_block_1 = EncoderBlock()
-    self.encoder_block_2 = EncoderBlock()
-    self.encoder_block_3 = EncoderBlock()
-
-    self.decoder_block_1 = DecoderBlock()
-    self.decoder_block_2 = DecoderBlock()
-    self.decoder_block_3 = DecoderBlock()
+    self.encoder_blocks = nn.ModuleList([EncoderBlock() for _ in range(3)])
+    self.decoder_blocks = nn.ModuleList([DecoderBlock() for _ in range(3)])
 
     self.linear_1 = nn.Linear(hp.embedding_size, hp.mel_freq) 
     self.linear_2 = nn.Linear(hp.embedding_size, 1)
 
+    if hp.torch_compile:
+      # conv + bn + act + dropout chains and residual add + layer norm are fused by inductor,
+      # in-place compile keeps state_dict keys unchanged
+      for module in [
+        self.encoder_prenet, 
+        self.postnet,
+        *self.encoder_blocks,
+        *self.decoder_blocks
+      ]:
+        module.compile(dynamic=True)
+
+      # Training forward as one graph: batches have bucketed static shapes (see text_mel_collate_fn),
+      # so CUDA graphs of reduce-overhead mode are reused between steps
+      self.forward = torch.compile(
+        self.forward, 
+        mode="reduce-overhead", 
+        dynamic=False
+      )
+
     self.norm_memory = nn.LayerNorm(
       normalized_shape=hp.embedding_size
     )
 
+    # True - future position, sliced for src/tgt/memory masks
+    self.register_buffer(
+      "causal_mask",
+      torch.ones(
+        (hp.max_mel_time, hp.max_mel_time), 
+        dtype=torch.bool
+      ).triu_(1),
+      persistent=False
+    )
+
+    # Checkpoints with encoder_block_1.., decoder_block_1.. keys still load
+    self.register_load_state_dict_pre_hook(rename_block_keys)
+
+
+  def fuse_for_inference(self):
+    # BatchNorm folding of pre-net and post-net, the model can't be trained after it
+    self.eval()
+    self.encoder_prenet.fuse_for_inference()
+    self.postnet.fuse_for_inference()
+    return self
+
+
+  def encode(
+    self,
+    text,
+    text_len
+  ):
+    S = text.shape[1]
+
+    # True - padding
+    src_key_padding_mask = ~mask_from_seq_lengths(
+      text_len,
+      max_length=S
+    ) # (N, S)
+
+    # (N, 1, S, S); True - take part in attention
+    src_attn_mask = ~(self.causal_mask[:S, :S] | src_key_padding_mask[:, None, None, :])
+
+    text_x = self.encoder_prenet(text) # (N, S, E)    
+    # Rows of pos_encoding.weight are the codes for 0..MAX_MEL_TIME positions,
+    # slicing them avoids the lookup of all MAX_MEL_TIME codes
+    text_x = text_x + self.pos_encoding.weight[:S]
+    # dropout after pos encoding?
+
+    for encoder_block in self.encoder_blocks:
+      if self.training and hp.activation_checkpointing:
+        text_x = checkpoint(
+          encoder_block,
+          text_x,
+          attn_mask = src_attn_mask,
+          use_reentrant=False
+        )
+      else:
+        text_x = encoder_block(
+          text_x, 
+          attn_mask = src_attn_mask
+        ) # (N, S, E)
+
+    text_x = self.norm_memory(text_x)
+
+    return text_x, src_key_padding_mask
+
 
   def forward(
     self, 
@@ -425,208 +653,260 @@ class TransformerTTS(nn.Module):
     mel_len
   ):  
     
-    N = text.shape[0]
     S = text.shape[1]
     TIME = mel.shape[1]
 
-    self.src_key_padding_mask = torch.zeros(
-        (N, S),
-        device=text.device
-    ).masked_fill(
-      ~mask_from_seq_lengths(
-        text_len,
-        max_length=S
-      ),
-      float("-inf")
-    )
-    
-    self.src_mask = torch.zeros(
-      (S, S),
-      device=text.device
-    ).masked_fill(
-      torch.triu(
-          torch.full(
-              (S, S), 
-              True,
-              dtype=torch.bool
-          ), 
-          diagonal=1
-      ).to(text.device),       
-      float("-inf")
-    )
-
-    self.tgt_key_padding_mask = torch.zeros(
-      (N, TIME),
-      device=mel.device
-    ).masked_fill(
-      ~mask_from_seq_lengths(
-        mel_len,
-        max_length=TIME
-      ),
-      float("-inf")
-    )
-
-    self.tgt_mask = torch.zeros(
-      (TIME, TIME),
-      device=mel.device
-    ).masked_fill(
-      torch.triu(
-          torch.full(
-              (TIME, TIME), 
-              True,
-              device=mel.device,
-              dtype=torch.bool
-          ), 
-          diagonal=1
-      ),       
-      float("-inf")
-    )
-
-    self.memory_mask = torch.zeros(
-      (TIME, S),
-      device=mel.device
-    ).masked_fill(
-      torch.triu(
-          torch.full(
-              (TIME, S), 
-              True,
-              device=mel.device,
-              dtype=torch.bool
-          ), 
-          diagonal=1          
-      ),       
-      float("-inf")
-    )    
+    text_x, src_key_padding_mask = self.encode(text, text_len) # (N, S, E), (N, S)
 
-    text_x = self.encoder_prenet(text) # (N, S, E)    
-    
-    pos_codes = self.pos_encoding(
-      torch.arange(hp.max_mel_time).to(mel.device)
-    ) # (MAX_S_TIME, E)
-
-    S = text_x.shape[1]
-    text_x = text_x + pos_codes[:S]
-    # dropout after pos encoding?
+    # True - padding
+    tgt_key_padding_mask = ~mask_from_seq_lengths(
+      mel_len,
+      max_length=TIME
+    ) # (N, TIME)
 
-    text_x = self.encoder_block_1(
-      text_x, 
-      attn_mask = self.src_mask, 
-      key_padding_mask = self.src_key_padding_mask
-    )
-    text_x = self.encoder_block_2(
-      text_x, 
-      attn_mask = self.src_mask, 
-      key_padding_mask = self.src_key_padding_mask
-    )    
-    text_x = self.encoder_block_3(
-      text_x, 
-      attn_mask = self.src_mask, 
-      key_padding_mask = self.src_key_padding_mask
-    ) # (N, S, E)
-
-    text_x = self.norm_memory(text_x)
+    # (N, 1, TIME, TIME), (N, 1, TIME, S); True - take part in attention
+    tgt_attn_mask = ~(self.causal_mask[:TIME, :TIME] | tgt_key_padding_mask[:, None, None, :])
+    memory_attn_mask = ~(self.causal_mask[:TIME, :S] | src_key_padding_mask[:, None, None, :])
         
     mel_x = self.decoder_prenet(mel) # (N, TIME, E)    
-    mel_x = mel_x + pos_codes[:TIME]
+    mel_x = mel_x + self.pos_encoding.weight[:TIME]
     # dropout after pos encoding?
 
-    mel_x = self.decoder_block_1(
-      x=mel_x,
-      memory=text_x,
-      x_attn_mask=self.tgt_mask, 
-      x_key_padding_mask=self.tgt_key_padding_mask,
-      memory_attn_mask=self.memory_mask,
-      memory_key_padding_mask=self.src_key_padding_mask
-    )
-
-    mel_x = self.decoder_block_2(
-      x=mel_x,
-      memory=text_x,
-      x_attn_mask=self.tgt_mask, 
-      x_key_padding_mask=self.tgt_key_padding_mask,
-      memory_attn_mask=self.memory_mask,
-      memory_key_padding_mask=self.src_key_padding_mask
-    )
-
-    mel_x = self.decoder_block_3(
-      x=mel_x,
-      memory=text_x,
-      x_attn_mask=self.tgt_mask, 
-      x_key_padding_mask=self.tgt_key_padding_mask,
-      memory_attn_mask=self.memory_mask,
-      memory_key_padding_mask=self.src_key_padding_mask
-    ) # (N, TIME, E)
+    for decoder_block in self.decoder_blocks:
+      if self.training and hp.activation_checkpointing:
+        mel_x = checkpoint(
+          decoder_block,
+          x=mel_x,
+          memory=text_x,
+          x_attn_mask=tgt_attn_mask, 
+          memory_attn_mask=memory_attn_mask,
+          use_reentrant=False
+        )
+      else:
+        mel_x = decoder_block(
+          x=mel_x,
+          memory=text_x,
+          x_attn_mask=tgt_attn_mask, 
+          memory_attn_mask=memory_attn_mask
+        ) # (N, TIME, E)
 
     mel_linear = self.linear_1(mel_x) # (N, TIME, FREQ)
+
     mel_postnet = self.postnet(mel_linear) # (N, TIME, FREQ)
     mel_postnet = mel_linear + mel_postnet # (N, TIME, FREQ)
     stop_token = self.linear_2(mel_x) # (N, TIME, 1)
 
-    bool_mel_mask = self.tgt_key_padding_mask.ne(0).unsqueeze(-1).repeat(
-      1, 1, hp.mel_freq
-    )
+    # Padded frames: zero mels and a certain stop token
+    mel_keep = (~tgt_key_padding_mask).unsqueeze(-1).to(mel_linear.dtype) # (N, TIME, 1)
+    mel_linear = mel_linear * mel_keep
+    mel_postnet = mel_postnet * mel_keep
 
-    mel_linear = mel_linear.masked_fill(
-      bool_mel_mask,
-      0
-    )
+    stop_token = torch.where(
+      tgt_key_padding_mask,
+      stop_token.new_full((), 1e3),
+      stop_token.squeeze(2)
+    ) # (N, TIME)
+    
+    return mel_postnet, mel_linear, stop_token 
+
+
+  def init_caches(self, memory, max_length):
+    # k, v buffers of the decoder blocks for `max_length` frames,
+    # memory k, v are the same for every step and projected once
+    N = memory.shape[0]
+    caches = []
+
+    for decoder_block in self.decoder_blocks:
+      self_attn = decoder_block.self_attn
+      memory_k, memory_v = decoder_block.attn.kv_projection(memory, memory)
+
+      caches.append({
+        "self_k": memory.new_zeros((N, self_attn.num_heads, max_length, self_attn.head_dim)),
+        "self_v": memory.new_zeros((N, self_attn.num_heads, max_length, self_attn.head_dim)),
+        "memory_k": memory_k,
+        "memory_v": memory_v
+      })
+
+    return caches
+
+
+  def decode_step(
+    self,
+    memory,
+    src_key_padding_mask,
+    mel_frame,
+    step,
+    caches,
+    length = None
+  ):
+    # mel_frame - (N, 1, FREQ) decoder input at position step - (1,) long tensor,
+    # length - step + 1, self-attention covers only the decoded frames then;
+    # with None shapes don't depend on step (static shapes for export, see DecoderStep)
+    S = memory.shape[1]
+
+    if length is None:
+      MAX_LENGTH = caches[0]["self_k"].shape[2]
+      # (1, MAX_LENGTH); True - take part in attention
+      x_attn_mask = ~self.causal_mask[:, :MAX_LENGTH].index_select(0, step)
+    else:
+      x_attn_mask = None
 
-    mel_postnet = mel_postnet.masked_fill(
-      bool_mel_mask,
-      0      
+    # (N, 1, 1, S); True - take part in attention
+    memory_attn_mask = ~(
+      self.causal_mask[:, :S].index_select(0, step) | src_key_padding_mask[:, None, None, :]
     )
 
-    stop_token = stop_token.masked_fill(
-      bool_mel_mask[:, :, 0].unsqueeze(-1),
-      1e3
-    ).squeeze(2)
-    
-    return mel_postnet, mel_linear, stop_token 
+    mel_x = self.decoder_prenet(mel_frame) # (N, 1, E)
+    mel_x = mel_x + self.pos_encoding(step)
+
+    for decoder_block, cache in zip(self.decoder_blocks, caches):
+      mel_x = decoder_block(
+        x=mel_x,
+        memory=memory,
+        x_attn_mask=x_attn_mask,
+        memory_attn_mask=memory_attn_mask,
+        cache=cache,
+        cache_index=step,
+        cache_length=length
+      ) # (N, 1, E)
+
+    mel_linear = self.linear_1(mel_x) # (N, 1, FREQ)
+    stop_token = self.linear_2(mel_x).squeeze(2) # (N, 1)
 
+    return mel_linear, stop_token
 
 
-  @torch.no_grad()
-  def inference(self, text, max_length=800, stop_token_threshold = 0.5, with_tqdm = True):
+  @torch.inference_mode()
+  def inference(
+    self, 
+    text, 
+    max_length=800, 
+    stop_token_threshold = 0.5, 
+    with_tqdm = True
+  ):
     self.eval()    
     self.train(False)
-    text_lengths = torch.tensor(text.shape[1]).unsqueeze(0).cuda()
+    text_lengths = torch.tensor(text.shape[1]).unsqueeze(0).to(text.device)
     N = 1
-    SOS = torch.zeros((N, 1, hp.mel_freq), device="cuda")
+
+    # Encoder output is the same for every step
+    memory, src_key_padding_mask = self.encode(text, text_lengths)
+    caches = self.init_caches(memory, max_length)
+
+    # Post-net output of the last frame depends only on the last `postnet_window` frames
+    postnet_window = 6 * int((hp.postnet_kernel_size - 1) / 2) + 1
+    # Checking the stop token waits for GPU, so it is checked every `stop_check_steps` steps
+    stop_check_steps = 8
     
-    mel_padded = SOS
-    mel_lengths = torch.tensor(1).unsqueeze(0).cuda()
-    stop_token_outputs = torch.FloatTensor([]).to(text.device)
+    step_index = torch.zeros(1, dtype=torch.long, device=text.device)
+    mel_frame = torch.zeros((N, 1, hp.mel_freq), device=text.device) # SOS
+    mel_linear_padded = torch.zeros((N, max_length, hp.mel_freq), device=text.device)
+    stop_token_padded = torch.zeros((N, max_length), device=text.device)
+    mel_length = max_length
+    stop_token_length = max_length
+    checked_length = 0
 
     if with_tqdm:
       iters = tqdm(range(max_length))
     else:
       iters = range(max_length)
 
-    for _ in iters:
-      mel_postnet, mel_linear, stop_token = self(
-        text, 
-        text_lengths,
-        mel_padded,
-        mel_lengths
-      )
+    # Conv shapes of the step are fixed (post-net window), so cuDNN autotuning pays off here,
+    # unlike training with different lengths in every batch
+    with torch.backends.cudnn.flags(
+      enabled=torch.backends.cudnn.enabled,
+      benchmark=True,
+      deterministic=torch.backends.cudnn.deterministic,
+      allow_tf32=torch.backends.cudnn.allow_tf32
+    ):
+      for step in iters:
+        step_index.fill_(step)
+
+        mel_linear, stop_token = self.decode_step(
+          memory,
+          src_key_padding_mask,
+          mel_frame,
+          step_index,
+          caches,
+          length=step + 1
+        )
+
+        mel_linear_padded[:, step] = mel_linear[:, 0]
+        stop_token_padded[:, step] = stop_token[:, 0]
+
+        mel_frame = mel_linear + self.postnet(
+          mel_linear_padded[:, max(0, step + 1 - postnet_window):step + 1]
+        )[:, -1:, :]
+
+        if (step + 1) % stop_check_steps == 0 or step + 1 == max_length:
+          # Only stop tokens written after the previous check
+          stop_steps = (
+            torch.sigmoid(stop_token_padded[0, checked_length:step + 1]) > stop_token_threshold
+          ).nonzero()
+        
+          if stop_steps.shape[0] > 0:
+            # Frames after the first stop are dropped
+            stop_token_length = checked_length + stop_steps[0, 0].item()
+            mel_length = stop_token_length + 1
+            break
 
-      mel_padded = torch.cat(
-        [
-          mel_padded,      
-          mel_postnet[:, -1:, :]
-        ], 
-        dim=1
-      )
-      if torch.sigmoid(stop_token[:,-1]) > stop_token_threshold:      
-        break
-      else:
-        stop_token_outputs = torch.cat([stop_token_outputs, stop_token[:,-1:]], dim=1)
-        mel_lengths = torch.tensor(mel_padded.shape[1]).unsqueeze(0).cuda()
+          checked_length = step + 1
+
+    mel_linear_padded = mel_linear_padded[:, :mel_length]
+    mel_postnet = mel_linear_padded + self.postnet(mel_linear_padded)
+
+    return mel_postnet, stop_token_padded[:, :stop_token_length]
 
-    return mel_postnet, stop_token_outputs
 
 
 
+class DecoderStep(nn.Module):
+  """
+  TransformerTTS.decode_step with tensors only in and out: k, v caches are
+  inputs and the updated ones are returned, so it can be traced (torch.jit.trace)
+  and exported to ONNX with static shapes, see export.py.
+  The model should be built with hp.torch_compile = False.
+  """
+  def __init__(self, model):
+    super(DecoderStep, self).__init__()
+    self.model = model
+
+  def forward(
+    self,
+    mel_frame,
+    step,
+    memory,
+    src_key_padding_mask,
+    self_k,
+    self_v,
+    memory_k,
+    memory_v
+  ):
+    # self_k, self_v - (BLOCKS, N, HEADS, MAX_LENGTH, HEAD_DIM)
+    # memory_k, memory_v - (BLOCKS, N, HEADS, S, HEAD_DIM)
+    caches = [
+      {
+        "self_k": self_k[i].clone(),
+        "self_v": self_v[i].clone(),
+        "memory_k": memory_k[i],
+        "memory_v": memory_v[i]
+      }
+      for i in range(self_k.shape[0])
+    ]
+
+    mel_linear, stop_token = self.model.decode_step(
+      memory,
+      src_key_padding_mask,
+      mel_frame,
+      step,
+      caches
+    )
+
+    self_k = torch.stack([cache["self_k"] for cache in caches])
+    self_v = torch.stack([cache["self_v"] for cache in caches])
+
+    return mel_linear, stop_token, self_k, self_v
+
 
 def test_with_dataloader():
   df = pd.read_csv(hp.csv_path)
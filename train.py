@@ -103,6 +103,10 @@ def calculate_test_loss(model, test_loader):
 if __name__ == "__main__":
   torch.manual_seed(hp.seed)
 
+  if hp.torch_compile:
+    # A compiled forward per (text bucket, mel bucket) pair instead of falling back to eager
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+
   df = pd.read_csv(hp.csv_path)  
   train_df, test_df = train_test_split(
     df, 
@@ -140,7 +144,9 @@ if __name__ == "__main__":
   criterion = TTSLoss().cuda()
   model = TransformerTTS().cuda()
   optimizer = torch.optim.AdamW(model.parameters(), lr=hp.lr)
-  scaler = torch.cuda.amp.GradScaler()  
+  # bfloat16 on Ampere+ needs no loss scaling, float16 for older GPUs (V100)
+  amp_dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+  scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)  
 
   best_test_loss_mean = float("inf")
   best_train_loss_mean = float("inf")
@@ -179,7 +185,7 @@ if __name__ == "__main__":
       model.train(True)
       model.zero_grad()
 
-      with torch.autocast(device_type='cuda', dtype=torch.float16):
+      with torch.autocast(device_type='cuda', dtype=amp_dtype):
         post_mel_out, mel_out, stop_token_out = model(
           text_padded, 
           text_lengths,